@@ -5,7 +5,6 @@ for experiment with `searchstims` stimuli
 that controls for target-distractor discriminability
 """
 from argparse import ArgumentParser
-from collections import defaultdict
 from pathlib import Path
 
 import pandas as pd
@@ -98,36 +97,7 @@ def main(results_gz_root,
 
     df_all = pd.concat(df_list)
 
-    # Get just the transfer learning results,
-    # then group by network, stimulus, and set size,
-    # and compute the mean accuracy for each set size.
-    df_transfer = df_all[df_all['method'] == 'transfer']
-    df_transfer_acc_mn = df_transfer.groupby(['net_name', 'stimulus', 'set_size']).agg({'accuracy':'mean'})
-    df_transfer_acc_mn = df_transfer_acc_mn.reset_index()
-
-    # Make one more `DataFrame`
-    # where variable is difference of mean accuracies on set size 1 and set size 8.
-    # We use this to organize the figure,
-    # and to show a heatmap with a marginal distribution.
-    records = defaultdict(list)
-
-    for net_name in df_transfer_acc_mn['net_name'].unique():
-        df_net = df_transfer_acc_mn[df_transfer_acc_mn['net_name'] == net_name]
-        for stim in df_net['stimulus'].unique():
-            df_stim = df_net[df_net['stimulus'] == stim]
-            set_size_1_acc = df_stim[df_stim['set_size'] == 1]['accuracy'].values.item()
-            set_size_8_acc = df_stim[df_stim['set_size'] == 8]['accuracy'].values.item()
-            acc_diff = set_size_1_acc - set_size_8_acc
-            records['net_name'].append(net_name)
-            records['stimulus'].append(stim)
-            records['set_size_1_acc'].append(set_size_1_acc)
-            records['set_size_8_acc'].append(set_size_8_acc)
-            records['acc_diff'].append(acc_diff)
-
-    df_acc_diff = pd.DataFrame.from_records(records)
-    df_acc_diff = df_acc_diff[['net_name', 'stimulus', 'set_size_1_acc', 'set_size_8_acc', 'acc_diff']]
-
-    # finally, save csvs
+    # finally, save csv
     df_all.to_csv(source_data_root.joinpath(all_csv_filename), index=False)
 
 
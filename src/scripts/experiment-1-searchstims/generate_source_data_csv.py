@@ -2,15 +2,64 @@
 # coding: utf-8
 """script that generates source data csvs for searchstims experiment figures"""
 from argparse import ArgumentParser
-from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import fnmatch
+import os
 from pathlib import Path
 
 import pandas as pd
+from pandas.api.types import union_categoricals
 import pyprojroot
 
 import searchnets
 
 
+def _stat_key(path):
+    """helper function that returns a string with the modification time and size of a file,
+    used in names of cached files so they are invalidated when the file changes"""
+    stat = Path(path).stat()
+    return f'{stat.st_mtime_ns}_{stat.st_size}'
+
+
+def _results_gz_to_df(job):
+    """helper function that unpacks a single job
+    and calls ``searchnets.analysis.searchstims.results_gz_to_df``.
+    Defined at module level so it can be pickled
+    and run by workers in a ``ProcessPoolExecutor``.
+
+    If ``cache_root`` is not None, the DataFrame is cached as a .parquet file in ``cache_root``.
+    The cached file's name includes the modification time and size of the results.gz file
+    and of the csv with dataset splits, so if either file changes, it will be converted again.
+    """
+    results_gz_path, csv_path, net_name, method, mode, learning_rate, cache_root = job
+    if cache_root is not None:
+        cache_path = Path(cache_root).joinpath(
+            f'{Path(results_gz_path).stem}_{net_name}_{method}_{mode}_{learning_rate}_'
+            f'{_stat_key(results_gz_path)}_{Path(csv_path).stem}_{_stat_key(csv_path)}.parquet'
+        )
+        if cache_path.exists():
+            return pd.read_parquet(cache_path)
+
+    df = searchnets.analysis.searchstims.results_gz_to_df(results_gz_path,
+                                                          csv_path,
+                                                          net_name,
+                                                          method,
+                                                          mode,
+                                                          learning_rate)
+
+    if cache_root is not None:
+        # write to a temporary file then rename it,
+        # so a run that's killed while writing can't leave a truncated file in the cache
+        tmp_path = cache_path.with_name(f'{cache_path.name}.{os.getpid()}.tmp')
+        try:
+            df.to_parquet(tmp_path, compression='snappy')
+            os.replace(tmp_path, cache_path)
+        finally:
+            if tmp_path.exists():
+                tmp_path.unlink()
+    return df
+
+
 def main(results_gz_root,
          source_data_root,
          all_csv_filename,
@@ -24,6 +73,8 @@ def main(results_gz_root,
          alexnet_split_csv_path,
          VGG16_split_csv_path,
          learning_rate=1e-3,
+         all_format='csv',
+         use_cache=True,
          ):
     """generate .csv files used as source data for figures corresponding to experiments
     carried out with stimuli generated by searchstims library
@@ -67,7 +118,33 @@ def main(results_gz_root,
         path to .csv that contains dataset splits for "VGG16-sized" searchstim images
     learning_rate
         float, learning rate value for all experiments. Default is 1e-3.
+    all_format : str
+        format to save results from **all** results.gz files in,
+        one of {'csv', 'parquet'}. Default is 'csv'.
+        If 'parquet', the suffix of all_csv_filename is replaced with '.parquet'.
+        The other, much smaller, files of group analyses are always saved as csv.
+    use_cache : bool
+        if True, cache the DataFrame made from each results.gz file
+        as a .parquet file in a '.cache' directory inside source_data_root,
+        so re-running the script doesn't convert unchanged results.gz files again.
+        Default is True.
     """
+    if all_format not in FORMATS:
+        raise ValueError(
+            f'invalid format: {all_format}, must be one of: {FORMATS}'
+        )
+
+    invalid_methods = set(methods) - VALID_METHODS
+    if invalid_methods:
+        raise ValueError(
+            f'invalid method(s): {invalid_methods}, must be one of: {sorted(VALID_METHODS)}'
+        )
+    invalid_modes = set(modes) - VALID_MODES
+    if invalid_modes:
+        raise ValueError(
+            f'invalid mode(s): {invalid_modes}, must be one of: {sorted(VALID_MODES)}'
+        )
+
     results_gz_root = Path(results_gz_root)
 
     source_data_root = Path(source_data_root)
@@ -76,106 +153,160 @@ def main(results_gz_root,
             f'directory specified as source_data_root not found: {source_data_root}'
         )
 
-    df_list = []
-
+    # cache DataFrames made from results.gz files, so re-running the script doesn't re-convert them
+    if use_cache:
+        cache_root = source_data_root.joinpath('.cache')
+        cache_root.mkdir(exist_ok=True)
+    else:
+        cache_root = None
+
+    # walk the directory tree just once, then filter the results.gz files for each experiment below
+    # and convert paths to strings once, instead of every time we filter them.
+    # The glob pattern for each experiment is matched against just the file name,
+    # and whether it's a 'detect' results.gz file is determined from the whole path
+    all_results_gz = [
+        (results_gz, results_gz.name, 'detect' in str(results_gz))
+        for results_gz in sorted(results_gz_root.glob('**/*gz'))
+    ]
+
+    # CORnet models take the same size images as alexnet
+    csv_path_by_net_name = {
+        'alexnet': alexnet_split_csv_path,
+        'CORnet_Z': alexnet_split_csv_path,
+        'CORnet_S': alexnet_split_csv_path,
+        'VGG16': VGG16_split_csv_path,
+    }
+
+    # first find all the results.gz files, then convert them to DataFrames in parallel
+    jobs = []
     for net_name in net_names:
+        try:
+            csv_path = csv_path_by_net_name[net_name]
+        except KeyError:
+            raise ValueError(f'no csv path defined for net_name: {net_name}') from None
+        # check here, so we fail before spending time converting any results.gz files
+        if not Path(csv_path).exists():
+            raise FileNotFoundError(
+                f'csv with dataset splits for net_name {net_name} not found: {csv_path}'
+            )
+
         for method in methods:
-            if method not in METHODS:
-                raise ValueError(
-                    f'invalid method: {method}, must be one of: {METHODS}'
-                )
             for mode in modes:
-                results_gz_path = sorted(results_gz_root.glob(f'**/*{net_name}*{method}*gz'))
+                pattern = f'*{net_name}*{method}*gz'
+                is_detect_mode = mode == 'detect'
+                results_gz_path = [
+                    results_gz for results_gz, results_gz_name, is_detect in all_results_gz
+                    if is_detect == is_detect_mode and fnmatch.fnmatchcase(results_gz_name, pattern)
+                ]
 
-                if mode == 'classify':                
-                    results_gz_path = [results_gz for results_gz in results_gz_path if 'detect' not in str(results_gz)]
-                elif mode == 'detect':
-                    results_gz_path = [results_gz for results_gz in results_gz_path if 'detect' in str(results_gz)]
-                else:
+                if len(results_gz_path) != 1:
                     raise ValueError(
-                        f'invalid mode: {mode}, must be one of: {MODES}'
+                        f'expected to find one results.gz file for net_name {net_name}, method {method}, '
+                        f'and mode {mode}, but found {len(results_gz_path)}: {results_gz_path}'
                     )
-
-                if len(results_gz_path) != 1:
-                    raise ValueError(f'found more than one results.gz file: {results_gz_path}')
                 results_gz_path = results_gz_path[0]
 
-                if net_name == 'alexnet' or 'CORnet' in net_name:
-                    csv_path = alexnet_split_csv_path
-                elif net_name == 'VGG16':
-                    csv_path = VGG16_split_csv_path
-                else:
-                    raise ValueError(f'no csv path defined for net_name: {net_name}')
-
-                df = searchnets.analysis.searchstims.results_gz_to_df(results_gz_path, 
-                                                                      csv_path, 
-                                                                      net_name,
-                                                                      method,
-                                                                      mode,
-                                                                      learning_rate)
-                df_list.append(df)
+                jobs.append(
+                    (results_gz_path, csv_path, net_name, method, mode, learning_rate, cache_root)
+                )
 
-    df_all = pd.concat(df_list)
+    with ProcessPoolExecutor() as executor:
+        df_list = list(executor.map(_results_gz_to_df, jobs, chunksize=1))
+
+    # use categorical dtype for columns of short repeated strings that we group by below,
+    # to save memory and speed up groupby. Note we pass `observed=True` to groupby + pivot_table
+    # so they don't create groups for every combination of categories.
+    # We give every DataFrame the same categories *before* concatenating,
+    # so `concat` keeps the categorical dtype instead of re-computing categories for each column.
+    # Categories are sorted, so they have the same order the original strings would sort in
+    for col in ('net_name', 'stimulus', 'method', 'mode'):
+        if all(col in df for df in df_list):
+            categories = union_categoricals(
+                [df[col].astype('category') for df in df_list], sort_categories=True
+            ).categories
+            for df in df_list:
+                df[col] = pd.Categorical(df[col], categories=categories)
+
+    df_all = pd.concat(df_list, copy=False, ignore_index=True)
+    del df_list
+
+    # save results from all results.gz files now, so we can free the memory they use
+    # before computing group analyses below
+    if all_format == 'csv':
+        df_all.to_csv(source_data_root.joinpath(all_csv_filename), index=False)
+    elif all_format == 'parquet':
+        df_all.to_parquet(source_data_root.joinpath(all_csv_filename).with_suffix('.parquet'),
+                          engine='pyarrow', compression='snappy', index=False)
 
     # Get just the transfer learning results,
     # then group by network, stimulus, and set size,
     # and compute the mean accuracy for each set size.
-    df_transfer = df_all[df_all['method'] == 'transfer']
-    df_transfer_acc_mn = df_transfer.groupby(['net_name', 'stimulus', 'set_size']).agg({'accuracy':'mean'})
+    # We only keep the columns we need, so we don't move the rest around when grouping
+    df_transfer = df_all.loc[df_all['method'] == 'transfer', ['net_name', 'stimulus', 'set_size', 'accuracy']]
+    del df_all
+    df_transfer_acc_mn = df_transfer.groupby(['net_name', 'stimulus', 'set_size'],
+                                             observed=True).agg({'accuracy':'mean'})
     df_transfer_acc_mn = df_transfer_acc_mn.reset_index()
+    del df_transfer
 
     # Make one more `DataFrame`
     # where variable is difference of mean accuracies on set size 1 and set size 8.
     # We use this to organize the figure,
     # and to show a heatmap with a marginal distribution.
-    records = defaultdict(list)
-
-    for net_name in df_transfer_acc_mn['net_name'].unique():
-        df_net = df_transfer_acc_mn[df_transfer_acc_mn['net_name'] == net_name]
-        for stim in df_net['stimulus'].unique():
-            df_stim = df_net[df_net['stimulus'] == stim]
-            set_size_1_acc = df_stim[df_stim['set_size'] == 1]['accuracy'].values.item()
-            set_size_8_acc = df_stim[df_stim['set_size'] == 8]['accuracy'].values.item()
-            acc_diff = set_size_1_acc - set_size_8_acc
-            records['net_name'].append(net_name)
-            records['stimulus'].append(stim)
-            records['set_size_1_acc'].append(set_size_1_acc)
-            records['set_size_8_acc'].append(set_size_8_acc)
-            records['acc_diff'].append(acc_diff)
-
-    df_acc_diff = pd.DataFrame.from_records(records)
+    # Pivot so there's one row per (net_name, stimulus) and one column per set size,
+    # instead of looping over nets and stimuli and masking the DataFrame for each one.
+    wide = (df_transfer_acc_mn
+            .pivot_table(index=['net_name', 'stimulus'], columns='set_size', values='accuracy',
+                         observed=True)
+            .rename(columns={1: 'set_size_1_acc', 8: 'set_size_8_acc'}))
+    wide['acc_diff'] = wide['set_size_1_acc'] - wide['set_size_8_acc']
+    df_acc_diff = wide.reset_index().rename_axis(columns=None)
     df_acc_diff = df_acc_diff[['net_name', 'stimulus', 'set_size_1_acc', 'set_size_8_acc', 'acc_diff']]
-
-    # columns will be stimuli, in increasing order of accuracy drop across models
-    stim_acc_diff_df = df_acc_diff.groupby(['stimulus']).agg({'acc_diff': 'mean', 'set_size_1_acc': 'mean'})
+    # with `observed=True`, groups of categoricals can come out in order of appearance, not sorted order,
+    # so sort explicitly to keep rows in the same order as grouping by strings
+    df_acc_diff = df_acc_diff.sort_values(by=['net_name', 'stimulus'], ignore_index=True)
+
+    # columns will be stimuli, in increasing order of accuracy drop across models.
+    # Here and below we group directly on the levels of the pivoted `wide` index,
+    # so the stim and net DataFrames are both derived from the one pivot
+    stim_acc_diff_df = wide.groupby(level='stimulus', observed=True).agg(
+        acc_diff=('acc_diff', 'mean'), set_size_1_acc=('set_size_1_acc', 'mean')
+    )
     stim_acc_diff_df = stim_acc_diff_df.reset_index()
     stim_acc_diff_df = stim_acc_diff_df.sort_values(by=['set_size_1_acc', 'acc_diff'], ascending=False)
 
     # rows will be nets, in decreasing order of accuracy drops across stimuli
-    net_acc_diff_df = df_acc_diff.groupby(['net_name']).agg({'acc_diff': 'mean'})
+    net_acc_diff_df = wide.groupby(level='net_name', observed=True).agg(acc_diff=('acc_diff', 'mean'))
     net_acc_diff_df = net_acc_diff_df.reset_index()
     net_acc_diff_df = net_acc_diff_df.sort_values(by='acc_diff', ascending=False)
+    del wide
 
-    # no idea how much I am abusing the Pandas API, just trying to make a pivot table into a data frame here
-    # https://stackoverflow.com/a/42708606/4906855
     # want the columns to be (sorted) stimulus type,
     # and rows be (sorted) network names,
-    # with values in cells being effect size
+    # with values in cells being effect size.
+    # Each (net_name, stimulus) pair is unique, so we can just reshape with `pivot`,
+    # there's no need to aggregate with `pivot_table`
     df_acc_diff_only = df_acc_diff[['net_name', 'stimulus', 'acc_diff']]
-    df_acc_diff_by_stim = df_acc_diff_only.pivot_table(index='net_name', columns='stimulus')
-    df_acc_diff_by_stim.columns = df_acc_diff_by_stim.columns.get_level_values(1)
-    df_acc_diff_by_stim = pd.DataFrame(df_acc_diff_by_stim.to_records())
-    df_acc_diff_by_stim = df_acc_diff_by_stim.set_index('net_name')
+    df_acc_diff_by_stim = df_acc_diff_only.pivot(index='net_name', columns='stimulus', values='acc_diff')
+    del df_acc_diff_only
     df_acc_diff_by_stim = df_acc_diff_by_stim.reindex(net_acc_diff_df['net_name'].values.tolist())
     df_acc_diff_by_stim = df_acc_diff_by_stim[stim_acc_diff_df['stimulus'].values.tolist()]
 
-    # finally, save csvs
-    df_all.to_csv(source_data_root.joinpath(all_csv_filename), index=False)
-    df_acc_diff.to_csv(source_data_root.joinpath(acc_diff_csv_filename), index=False)
-    stim_acc_diff_df.to_csv(source_data_root.joinpath(stim_acc_diff_csv_filename), index=False)
-    net_acc_diff_df.to_csv(source_data_root.joinpath(net_acc_diff_csv_filename), index=False)
-    # for this csv, the index is "net names" -- we want to keep it
-    df_acc_diff_by_stim.to_csv(source_data_root.joinpath(acc_diff_by_stim_csv_filename))
+    # finally, save csvs. Each is written independently, so we write them concurrently
+    to_save = [
+        (df_acc_diff, acc_diff_csv_filename, False),
+        (stim_acc_diff_df, stim_acc_diff_csv_filename, False),
+        (net_acc_diff_df, net_acc_diff_csv_filename, False),
+        # for this csv, the index is "net names" -- we want to keep it
+        (df_acc_diff_by_stim, acc_diff_by_stim_csv_filename, True),
+    ]
+    with ThreadPoolExecutor(max_workers=len(to_save)) as executor:
+        futures = [
+            executor.submit(df.to_csv, source_data_root.joinpath(csv_filename), index=index)
+            for df, csv_filename, index in to_save
+        ]
+        for future in futures:
+            future.result()  # re-raises any exception from writing a csv
 
 
 ROOT = pyprojroot.here()
@@ -201,6 +332,14 @@ METHODS = [
 
 MODES = ['classify']
 
+VALID_METHODS = frozenset({'initialize', 'transfer'})
+VALID_MODES = frozenset({'classify', 'detect'})
+
+FORMATS = [
+    'csv',
+    'parquet',
+]
+
 SEARCHSTIMS_OUTPUT_ROOT = ROOT.joinpath('../visual_search_stimuli')
 alexnet_split_csv_path = SEARCHSTIMS_OUTPUT_ROOT.joinpath(
     'alexnet_multiple_stims/alexnet_multiple_stims_128000samples_balanced_split.csv')
@@ -250,6 +389,13 @@ def get_parser():
     parser.add_argument('--modes', default=MODES,
                         help='comma-separate list of training "modes", must be in {"classify","detect"}',
                         type=lambda modes: modes.split(','))
+    parser.add_argument('--format', dest='all_format', default='csv', choices=FORMATS,
+                        help=('format to save results from **all** results.gz files in. '
+                              'If "parquet", the suffix of all_csv_filename is replaced with ".parquet". '
+                              'Default is "csv".'))
+    parser.add_argument('--no_cache', dest='use_cache', action='store_false',
+                        help=('do not cache DataFrames made from results.gz files '
+                              'in a ".cache" directory inside source_data_root'))
     parser.add_argument('--learning_rate', default=LEARNING_RATE,
                         help=f'float, learning rate value for all experiments. Default is {LEARNING_RATE}')
     parser.add_argument('--alexnet_split_csv_path', default=alexnet_split_csv_path,
@@ -275,4 +421,6 @@ if __name__ == '__main__':
          alexnet_split_csv_path=args.alexnet_split_csv_path,
          VGG16_split_csv_path=args.VGG16_split_csv_path,
          learning_rate=args.learning_rate,
+         all_format=args.all_format,
+         use_cache=args.use_cache,
          )